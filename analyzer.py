@@ -1,167 +1,327 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import datetime
+import io
+import os
+import time
 import pandas as pd
 import numpy as np
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuración
 TICKER_LIMIT = 600
 MIN_MARKET_CAP = 5_000_000_000
+TV_MAX_WORKERS = 6
+CACHE_DIR = '.cache'
+SP500_CACHE = os.path.join(CACHE_DIR, 'sp500_tickers.json')
+SP500_CACHE_TTL = 7 * 86400 # segundos; el índice cambia pocas veces al año
+TV_CACHE = os.path.join(CACHE_DIR, 'tv_rows.json')
+TV_CACHE_TTL = 3600 # segundos; el scanner cambia pocas veces al día
+MAX_EX_DIV_TS = 4102444800 # 2100-01-01 UTC; por encima no es una fecha en segundos válida
+
+# Columnas solicitadas al scanner de TV -> nombre del campo en process_results.
+# Solo se piden las que se usan: cada columna extra viaja en todas las filas.
+TV_COLUMNS = {
+    "name": "full_symbol",
+    "close": "price",
+    "market_cap_basic": "market_cap",
+    "dividend_yield_recent": "div_yield",
+    "Recommend.All": "rec_score",
+    "Perf.5Y": "perf_5y",
+    "Volatility.M": "volatility_m",
+    "description": "name",
+    "sector": "sector",
+    "dividend_ex_date_recent": "ex_div_ts"
+}
+
+# Sesión HTTP compartida: reutiliza conexiones (keep-alive) entre peticiones y
+# reintenta errores transitorios y 429 con backoff exponencial (respeta Retry-After)
+_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "POST"]
+)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=_RETRY))
+_SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+})
+
+def _load_cache(path):
+    """Lee un fichero de caché JSON; devuelve None si no existe o está corrupto."""
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def _save_cache(path, obj):
+    """Escribe un fichero de caché JSON. Es best-effort: un fallo se registra y no
+    interrumpe el análisis."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj))
+    except OSError as e:
+        print(f"No se pudo escribir la caché {path}: {e}")
+
+def _cache_age(path):
+    """Segundos desde la última escritura del fichero (infinito si no se puede leer)."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return float('inf')
 
 def get_sp500_tickers():
     """Obtiene la lista oficial de tickers del S&P 500."""
+    print("Obteniendo tickers del S&P 500...")
+    url = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
+
+    cached = _load_cache(SP500_CACHE)
+    if not (isinstance(cached, dict) and isinstance(cached.get('tickers'), list)):
+        cached = None
+
+    # Lista reciente en disco: ni siquiera se consulta Wikipedia
+    if cached and _cache_age(SP500_CACHE) < SP500_CACHE_TTL:
+        return cached['tickers']
+
     try:
-        print("Obteniendo tickers del S&P 500...")
-        url = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers)
-        table = pd.read_html(response.text)
-        return [t.replace('.', '-') for t in table[0]['Symbol'].tolist()]
+        # GET condicional: si la página no cambió, Wikipedia responde 304 sin cuerpo
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = _SESSION.get(url, headers=headers, timeout=20)
+        if response.status_code == 304 and cached:
+            try:
+                os.utime(SP500_CACHE) # Renueva la vigencia de la lista en disco
+            except OSError as e:
+                print(f"No se pudo renovar la caché {SP500_CACHE}: {e}")
+            return cached['tickers']
+        response.raise_for_status()
+
+        table = pd.read_html(io.BytesIO(response.content), flavor='lxml', attrs={'id': 'constituents'})
+        tickers = table[0]['Symbol'].str.replace('.', '-', regex=False).tolist()
     except Exception as e:
         print(f"Error obteniendo S&P 500: {e}")
+        if cached:
+            # Una lista antigua del índice es mejor que la lista mínima de respaldo
+            print("Usando la lista del S&P 500 en caché.")
+            return cached['tickers']
         return ['AAPL', 'MSFT', 'GOOG', 'JNJ', 'KO', 'PEP', 'O', 'XOM', 'CVX']
 
+    _save_cache(SP500_CACHE, {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'tickers': tickers
+    })
+    return tickers
+
+def _post_chunk(url, headers, payload):
+    """Envía un lote al scanner de TradingView y devuelve sus filas (None si falla)."""
+    try:
+        resp = _SESSION.post(url, headers=headers, json=payload, timeout=20)
+        if resp.status_code == 200:
+            body = resp.json()
+            # Solo una lista en 'data' es un lote válido; un cuerpo de error con
+            # status 200 se trata como fallo para no cachear sus tickers como vacíos
+            if isinstance(body, dict) and isinstance(body.get('data'), list):
+                return body['data']
+            print(f"Respuesta inesperada del scanner: {str(body)[:200]}")
+        else:
+            print(f"Error batch: {resp.status_code}")
+    except Exception as e:
+        print(f"Excepción en lote: {e}")
+    return None
+
+def _row_ticker(row):
+    """"NYSE:BRK.B" -> "BRK-B", el formato de la lista del S&P 500."""
+    return row.get('s', '').split(':', 1)[-1].replace('.', '-')
+
+def _scan(url, headers, query, candidates):
+    """Consulta el scanner en lotes paralelos.
+
+    Devuelve {ticker: filas} con una entrada (posiblemente vacía) por cada ticker
+    de los lotes que respondieron; los tickers de lotes fallidos no aparecen.
+    """
+    # Procesar en lotes de 200
+    chunk_size = 200 
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    payloads = [{"symbols": {"tickers": chunk}, **query} for chunk in chunks]
+
+    # Los lotes son independientes: se envían en paralelo sobre la sesión compartida.
+    # map() conserva el orden de los lotes para que el resultado sea estable.
+    fetched = {}
+    if payloads:
+        with ThreadPoolExecutor(max_workers=TV_MAX_WORKERS) as executor:
+            for chunk, rows in zip(chunks, executor.map(lambda p: _post_chunk(url, headers, p), payloads)):
+                if rows is None:
+                    continue # Lote fallido: no se cachea, se reintenta en la próxima ejecución
+                for candidate in chunk:
+                    fetched.setdefault(candidate.split(':', 1)[1], [])
+                for row in rows:
+                    fetched.setdefault(_row_ticker(row), []).append(row)
+    return fetched
+
+def _load_tv_cache():
+    """Devuelve {ticker: {'ts', 'rows'}} de la caché del scanner.
+
+    Cualquier fichero con otra forma, o pedido con otras columnas (las filas son
+    posicionales), se trata como caché vacía.
+    """
+    stored = _load_cache(TV_CACHE)
+    if not isinstance(stored, dict) or stored.get('columns') != list(TV_COLUMNS):
+        return {}
+    tickers = stored.get('tickers')
+    if not isinstance(tickers, dict):
+        return {}
+    return {
+        t: entry for t, entry in tickers.items()
+        if isinstance(entry, dict)
+        and isinstance(entry.get('ts'), (int, float))
+        and isinstance(entry.get('rows'), list)
+    }
+
 def fetch_tv_data_batch(tickers):
-    """Obtiene datos fundamentales y técnicos de TradingView para una lista de tickers."""
+    """Obtiene datos fundamentales y técnicos de TradingView para una lista de tickers.
+
+    Las filas se guardan por ticker en disco durante TV_CACHE_TTL segundos; solo
+    se piden al scanner los tickers sin entrada vigente.
+    """
     url = "https://scanner.tradingview.com/america/scan"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Content-Type": "application/x-www-form-urlencoded"
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    query = {"columns": list(TV_COLUMNS)}
+    # Los filtros de process_results, aplicados en el servidor: el scanner solo
+    # devuelve filas que los cumplen, así viajan menos bytes
+    filtered_query = {
+        **query,
+        "filter": [
+            {"left": "market_cap_basic", "operation": "egreater", "right": MIN_MARKET_CAP},
+            {"left": "dividend_yield_recent", "operation": "greater", "right": 0}
+        ]
     }
 
-    # Columnas solicitadas (Mapped to TV Scanner fields)
-    columns = [
-        "name", "close", "market_cap_basic", "dividend_yield_recent", 
-        "Recommend.All", "Perf.5Y", "Volatility.M", "average_volume_10d_calc",
-        "description", "sector", "dividend_ex_date_recent"
-    ]
+    now = time.time()
+    cache = {
+        t: entry for t, entry in _load_tv_cache().items()
+        if now - entry['ts'] < TV_CACHE_TTL
+    }
+    unique = list(dict.fromkeys(tickers)) # Sin repetidos: cada ticker se consulta una vez
+    missing = [t for t in unique if t not in cache]
+    print(f"TradingView: {len(unique) - len(missing)} en caché, {len(missing)} a consultar")
 
-    all_data = []
-    
-    # Generate candidates with both NASDAQ and NYSE prefixes to ensure we find the stock
-    # S&P 500 mix is approx 70% NYSE, 30% NASDAQ.
-    candidates = []
-    for t in tickers:
-        candidates.append(f"NASDAQ:{t}")
-        candidates.append(f"NYSE:{t}")
-        # AMEX is rare in S&P 500 but if missing we could add AMEX:{t} too
-    
-    # Procesar en lotes de 200 (100 pairs)
-    chunk_size = 200 
-    for i in range(0, len(candidates), chunk_size):
-        chunk = candidates[i:i + chunk_size]
-        
-        payload = {
-            "symbols": {"tickers": chunk},
-            "columns": columns
-        }
-        
-        try:
-            # print(f"Solicitando lote {i // chunk_size + 1} ({len(chunk)} candidatos)...") 
-            resp = requests.post(url, headers=headers, json=payload, timeout=20)
-            if resp.status_code == 200:
-                data = resp.json()
-                if 'data' in data:
-                    all_data.extend(data['data'])
-            else:
-                print(f"Error batch {i}: {resp.status_code}")
-            
-            time.sleep(0.5) 
-            
-        except Exception as e:
-            print(f"Excepción en lote {i}: {e}")
+    # Two-phase lookup: one exchange prefix per ticker, then the other one only
+    # for tickers that returned nothing. S&P 500 mix is approx 70% NYSE, 30% NASDAQ,
+    # so NYSE goes first. AMEX is rare in S&P 500 but could be a third phase.
+    # Phase 1 goes out unfiltered: an empty answer must mean "not listed on NYSE",
+    # not "listed but filtered out", or every NYSE non-payer or small cap would be
+    # re-sent to NASDAQ. Only the retry phase, whose empty answers are final
+    # anyway, carries the server-side filter.
+    fetched = _scan(url, headers, query, [f"NYSE:{t}" for t in missing])
+    retry = [t for t in missing if t in fetched and not fetched[t]]
+    second = _scan(url, headers, filtered_query, [f"NASDAQ:{t}" for t in retry])
+    for t in retry:
+        del fetched[t] # Se reemplaza con la segunda fase (o no se cachea si su lote falló)
+    for t, rows in second.items():
+        fetched.setdefault(t, []).extend(rows)
 
+    # Tickers sin filas también se guardan, para no volver a pedirlos dentro del TTL
+    cache.update({t: {'ts': now, 'rows': rows} for t, rows in fetched.items()})
+    _save_cache(TV_CACHE, {'columns': list(TV_COLUMNS), 'tickers': cache})
+
+    all_data = []
+    for t in dict.fromkeys(unique + list(fetched)):
+        if t in cache:
+            all_data.extend(cache[t]['rows'])
     return all_data
 
 def process_results(tv_results):
-    processed_map = {} # Deduplicate by symbol
-    
-    for item in tv_results:
-        try:
-            d = item['d']
-            full_symbol = d[0] # "NASDAQ:AAPL"
-            clean_symbol = full_symbol.split(':')[1] if ':' in full_symbol else full_symbol
-            
-            # If we already have this symbol processed, skip (or overwrite if this exchange is preferred?)
-            # Usually only one works. If both return data, it's a dual listing.
-            if clean_symbol in processed_map:
-                continue
-                
-            price = d[1]
-            market_cap = d[2]
-            div_yield = d[3] if d[3] is not None else 0
-            rec_score = d[4] if d[4] is not None else 0
-            perf_5y = d[5] if d[5] is not None else 0
-            volatility_m = d[6] if d[6] is not None else 0
-            # volume = d[7]
-            name = d[8]
-            sector = d[9]
-            ex_div_ts = d[10]
-
-            # Filters
-            if not market_cap or market_cap < MIN_MARKET_CAP: continue
-            if not div_yield or div_yield <= 0: continue # Must pay dividend
-
-            # Normalizations
-            # Div Yield from TV is often percentage (0-100) or decimal? 
-            # In debug: AAPL 0.37. AAPL yield is ~0.5%. Usually TV returns percentage. 0.37 means 0.37%.
-            
-            # Recommendation
-            tv_signal = "NEUTRAL"
-            if rec_score > 0.5: tv_signal = "STRONG_BUY"
-            elif rec_score > 0.1: tv_signal = "BUY"
-            elif rec_score < -0.5: tv_signal = "STRONG_SELL"
-            elif rec_score < -0.1: tv_signal = "SELL"
-            
-            # AI Score Calculation
-            score_growth = min(max(perf_5y, 0), 100) * 0.4 
-            
-            score_stability = 0
-            if volatility_m > 0:
-                score_stability = max(0, 40 - (volatility_m * 4)) 
-            
-            score_yield = min(div_yield * 5, 20)
-            
-            score_signal = 0
-            if "BUY" in tv_signal: score_signal = 10
-            if "STRONG_BUY" in tv_signal: score_signal = 20
-            
-            raw_score = score_growth + score_stability + score_yield + score_signal
-            final_score = min(round(raw_score), 100)
-
-            # Dates
-            ex_div_str = "N/A"
-            if ex_div_ts:
-                try:
-                    # TV might return seconds
-                    dt = datetime.datetime.fromtimestamp(ex_div_ts)
-                    ex_div_str = dt.strftime('%Y-%m-%d')
-                except:
-                    pass
-
-            processed_map[clean_symbol] = {
-                'symbol': clean_symbol,
-                'name': name,
-                'price': float(price),
-                'slope': round(perf_5y / 100, 4), # Proxy for slope
-                'r_squared': round(1.0 / (volatility_m if volatility_m > 0 else 1), 2), # Proxy
-                'growth_5y_pct': round(perf_5y, 2),
-                'dividend_yield_pct': round(div_yield, 2),
-                'start_price': 0, # Legacy
-                'end_price': price,
-                'ex_div_date': ex_div_str,
-                'est_next_payment': round(div_yield / 100 * price / 4, 3), # Approx quarterly
-                'annual_dividend': round(div_yield / 100 * price, 2),
-                'sector': sector,
-                'tv_signal': tv_signal,
-                'score': final_score
-            }
-            
-        except Exception as e:
-            continue
-            
-    return list(processed_map.values())
+    rows = [item['d'] for item in tv_results if item.get('d')]
+    df = pd.DataFrame(rows, columns=list(TV_COLUMNS.values()))
+
+    # "NASDAQ:AAPL" -> "AAPL"
+    df['symbol'] = df['full_symbol'].str.split(':', n=1).str[-1]
+    for col in ("price", "market_cap", "div_yield", "rec_score", "perf_5y", "volatility_m", "ex_div_ts"):
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in ("div_yield", "rec_score", "perf_5y", "volatility_m"):
+        df[col] = df[col].fillna(0)
+
+    # Filters: market cap floor and must pay dividend
+    mask = (
+        df['symbol'].notna()
+        & df['price'].notna()
+        & (df['market_cap'] >= MIN_MARKET_CAP)
+        & (df['div_yield'] > 0)
+    )
+    # Usually only one exchange works. If both return data, it's a dual listing: keep the first.
+    df = df[mask].drop_duplicates('symbol', keep='first')
+
+    # Normalizations
+    # Div Yield from TV is often percentage (0-100) or decimal? 
+    # In debug: AAPL 0.37. AAPL yield is ~0.5%. Usually TV returns percentage. 0.37 means 0.37%.
+    price = df['price']
+    div_yield = df['div_yield']
+    perf_5y = df['perf_5y']
+    volatility_m = df['volatility_m']
+
+    # Recommendation (first matching condition wins, as in an if/elif chain)
+    rec_score = df['rec_score'].to_numpy()
+    tv_signal = np.select(
+        [rec_score > 0.5, rec_score > 0.1, rec_score < -0.5, rec_score < -0.1],
+        ["STRONG_BUY", "BUY", "STRONG_SELL", "SELL"],
+        default="NEUTRAL"
+    )
+
+    # AI Score Calculation
+    score_growth = perf_5y.clip(0, 100) * 0.4
+    score_stability = np.where(volatility_m > 0, np.maximum(0, 40 - volatility_m * 4), 0)
+    score_yield = np.minimum(div_yield * 5, 20)
+    score_signal = np.where(tv_signal == "STRONG_BUY", 20, np.where(tv_signal == "BUY", 10, 0))
+    raw_score = score_growth + score_stability + score_yield + score_signal
+
+    # Dates (TV returns seconds, UTC); missing, zero or out-of-range -> "N/A".
+    # The explicit range (1970 .. 2100) keeps milliseconds, inf and huge values out
+    # of to_datetime, whose coerce behaviour for them depends on the pandas version.
+    ex_div_ts = df['ex_div_ts'].where((df['ex_div_ts'] > 0) & (df['ex_div_ts'] < MAX_EX_DIV_TS))
+    ex_div_date = (
+        pd.to_datetime(ex_div_ts, unit='s', errors='coerce')
+        .dt.strftime('%Y-%m-%d')
+        .fillna("N/A")
+    )
+
+    # Bulk rounding (Series.round / np.round) scales and then rounds half-to-even,
+    # so near-ties can come out 0.01 away from Python's round(): 2.5 / 100 * 137 =
+    # 3.4250000000000003 gives 3.42 here vs 3.43 with round(). Missing Perf.5Y gives
+    # growth_5y_pct 0.0 rather than 0. Both are accepted for the vectorized path.
+    annual_dividend = div_yield / 100 * price
+    out = pd.DataFrame({
+        'symbol': df['symbol'],
+        'name': df['name'],
+        'price': price,
+        'slope': (perf_5y / 100).round(4), # Proxy for slope
+        'r_squared': (1.0 / volatility_m.where(volatility_m > 0, 1)).round(2), # Proxy
+        'growth_5y_pct': perf_5y.round(2),
+        'dividend_yield_pct': div_yield.round(2),
+        'start_price': 0, # Legacy
+        'end_price': price,
+        'ex_div_date': ex_div_date,
+        'est_next_payment': (annual_dividend / 4).round(3), # Approx quarterly
+        'annual_dividend': annual_dividend.round(2),
+        'sector': df['sector'],
+        'tv_signal': tv_signal,
+        'score': np.minimum(raw_score.round(), 100).astype(np.int64)
+    })
+    # Sort by Score (stable: ties keep scanner order)
+    out = out.sort_values('score', ascending=False, kind='stable')
+    # Missing text fields (name, sector) become None -> null in the JSON
+    return out.astype(object).where(out.notna(), None).to_dict(orient='records')
 
 def main():
     print("Iniciando análisis AI DIVIDENDS (TradingView Native)...")
@@ -176,24 +336,21 @@ def main():
     # Batch processing
     raw_data = fetch_tv_data_batch(tickers)
     
-    # Process
+    # Process (sorted by score)
     results = process_results(raw_data)
     
-    # Sort by Score
-    results.sort(key=lambda x: x['score'], reverse=True)
-    
     # Output structure
     final_output = {
         "metadata": {
             "last_updated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "total_analyzed": len(raw_data)
+            "total_analyzed": len(tickers)
         },
         "data": results
     }
 
-    # Save
-    with open('stocks_data.json', 'w') as f:
-        json.dump(final_output, f, indent=2)
+    # Save (orjson escribe NaN/Inf como null, stdlib json emitiría NaN inválido)
+    with open('stocks_data.json', 'wb') as f:
+        f.write(orjson.dumps(final_output, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
         
     print(f"Análisis completado. {len(results)} empresas seleccionadas.")
     print("Datos guardados en stocks_data.json.")